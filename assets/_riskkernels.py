@@ -0,0 +1,86 @@
+# assets/_riskkernels.py
+import math
+import numpy as np
+
+
+def _compute_risk(values, rf_daily):
+    """
+    Compute portfolio risk metrics from an ordered array of portfolio values
+    in a single fused loop (returns, running peak and drawdown together)
+    Returns tuple: (n_returns, volatility_30d, volatility_90d, max_drawdown, sharpe_ratio, var_95)
+    """
+    n = values.shape[0]
+    returns = np.empty(max(n - 1, 0), dtype=np.float64)
+    n_returns = 0
+    total = 0.0
+    peak = values[0] if n > 0 else 0.0
+    max_drawdown = 0.0
+
+    for i in range(1, n):
+        prev = values[i - 1]
+        value = values[i]
+
+        # Daily log return, skipping days touching a zero value
+        if prev > 0 and value > 0:
+            daily_return = math.log(value / prev)
+            returns[n_returns] = daily_return
+            n_returns += 1
+            total += daily_return
+
+        # Running peak and drawdown from it
+        if value > peak:
+            peak = value
+        if peak > 0:
+            drawdown = 1.0 - value / peak
+            if drawdown > max_drawdown:
+                max_drawdown = drawdown
+
+    if n_returns < 5:
+        return n_returns, 0.0, 0.0, 0.0, 0.0, 0.0
+
+    # Standard deviation over all returns and over the most recent 30
+    mean_return = total / n_returns
+    window = 30 if n_returns >= 30 else n_returns
+    window_total = 0.0
+    for i in range(n_returns - window, n_returns):
+        window_total += returns[i]
+    window_mean = window_total / window
+
+    sq_all = 0.0
+    sq_window = 0.0
+    for i in range(n_returns):
+        sq_all += (returns[i] - mean_return) ** 2
+        if i >= n_returns - window:
+            sq_window += (returns[i] - window_mean) ** 2
+    std_all = math.sqrt(sq_all / n_returns)
+    std_window = math.sqrt(sq_window / window)
+
+    # Sharpe ratio (annualised)
+    if std_all > 0:
+        sharpe_ratio = (mean_return - rf_daily) / std_all * math.sqrt(365)
+    else:
+        sharpe_ratio = 0.0
+
+    # 5th percentile of returns (k-th smallest via partial sort)
+    k = max(0, int(0.05 * n_returns))
+    percentile_5 = np.partition(returns[:n_returns], k)[k]
+
+    return (
+        n_returns,
+        std_window * 100.0,
+        std_all * 100.0,
+        max_drawdown * 100.0,
+        sharpe_ratio,
+        abs(percentile_5 * 100.0),
+    )
+
+
+# Numba signature of the kernel, shared by the JIT and ahead-of-time builds
+SIGNATURE = 'Tuple((i8, f8, f8, f8, f8, f8))(f8[::1], f8)'
+
+try:
+    # Ahead-of-time compiled build (see assets/build_risk_kernels.py), needs no JIT warm-up
+    from ._riskkernels_aot import compute_risk
+except ImportError:
+    from numba import njit
+    compute_risk = njit(SIGNATURE, cache=True)(_compute_risk)
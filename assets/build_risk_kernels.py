@@ -0,0 +1,22 @@
+# assets/build_risk_kernels.py
+"""
+Ahead-of-time compile the risk metrics kernel into assets/_riskkernels_aot.*.so,
+so web/worker processes load native code instead of JIT-compiling on start-up.
+Run during the build step, from the project root:
+
+    python -m assets.build_risk_kernels
+
+If the compiled module is missing (or built for another platform),
+assets._riskkernels falls back to the numba JIT, and assets.services falls
+back to plain NumPy when numba isn't installed either.
+"""
+import os
+from numba.pycc import CC
+from assets._riskkernels import SIGNATURE, _compute_risk
+
+cc = CC('_riskkernels_aot')
+cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+cc.export('compute_risk', SIGNATURE)(_compute_risk)
+
+if __name__ == '__main__':
+    cc.compile()
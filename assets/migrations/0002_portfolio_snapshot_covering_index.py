@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-14 18:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='portfoliosnapshot',
+            name='assets_port_portfol_e53438_idx',
+        ),
+        migrations.AddIndex(
+            model_name='portfoliosnapshot',
+            index=models.Index(fields=['portfolio', 'timestamp'], include=('total_value_usd',), name='snap_cover_idx'),
+        ),
+    ]
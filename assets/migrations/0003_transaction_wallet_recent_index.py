@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-14 18:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assets', '0002_portfolio_snapshot_covering_index'),
+        ('wallets', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='transaction',
+            name='assets_tran_wallet__b1c89b_idx',
+        ),
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['wallet', '-timestamp'], name='tx_wallet_recent_idx'),
+        ),
+    ]
@@ -81,7 +81,9 @@ class PortfolioSnapshot(models.Model):
     
     class Meta:
         indexes = [
-            models.Index(fields=['portfolio', 'timestamp']),
+            # Covering index: the risk metrics window reads only total_value_usd,
+            # so PostgreSQL can answer it with an index-only scan
+            models.Index(fields=['portfolio', 'timestamp'], include=['total_value_usd'], name='snap_cover_idx'),
         ]
     
     def __str__(self):
@@ -120,7 +122,8 @@ class Transaction(models.Model):
     class Meta:
         unique_together = ('wallet', 'transaction_hash')
         indexes = [
-            models.Index(fields=['wallet', 'timestamp']),
+            # Newest-first per wallet, matching the transaction history ordering
+            models.Index(fields=['wallet', '-timestamp'], name='tx_wallet_recent_idx'),
         ]
     
     def __str__(self):
@@ -27,6 +27,15 @@ class TokenTransferSerializer(serializers.ModelSerializer):
         model = TokenTransfer
         fields = ['id', 'token', 'from_address', 'to_address', 'value', 'value_usd']
 
+class TokenTransferListSerializer(serializers.ModelSerializer):
+    # Flat token projection for list endpoints, the nested TokenSerializer is for detail views
+    token_symbol = serializers.CharField(source='token.symbol', read_only=True)
+    token_logo_url = serializers.URLField(source='token.logo_url', read_only=True)
+    
+    class Meta:
+        model = TokenTransfer
+        fields = ['id', 'token_symbol', 'token_logo_url', 'from_address', 'to_address', 'value', 'value_usd']
+
 class TransactionSerializer(serializers.ModelSerializer):
     token_transfers = TokenTransferSerializer(many=True, read_only=True)
     
@@ -38,6 +47,12 @@ class TransactionSerializer(serializers.ModelSerializer):
             'transaction_fee', 'transaction_type', 'status', 'token_transfers'
         ]
 
+class TransactionListSerializer(TransactionSerializer):
+    token_transfers = TokenTransferListSerializer(many=True, read_only=True)
+    
+    class Meta(TransactionSerializer.Meta):
+        pass
+
 class PortfolioSnapshotSerializer(serializers.ModelSerializer):
     class Meta:
         model = PortfolioSnapshot
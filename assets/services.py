@@ -1,79 +1,308 @@
 # assets/services.py
+import math
+import decimal
+import functools
+import threading
+from collections import OrderedDict
 import numpy as np
 from decimal import Decimal
-from datetime import datetime, timedelta
+from datetime import timedelta
+from django.db import DatabaseError, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
 from .models import Portfolio, PortfolioSnapshot, RiskMetrics
 
+try:
+    from ._riskkernels import compute_risk
+except ImportError:
+    # Neither the ahead-of-time build nor numba is available, fall back to plain NumPy
+    compute_risk = None
+
+# Daily risk-free rate (assuming 2% per year)
+DAILY_RISK_FREE_RATE = 0.02 / 365
+
+# Risk metric columns are DecimalField(decimal_places=2), the largest magnitude
+# each one can hold follows from its max_digits
+Q2 = Decimal('0.01')
+Q2_CTX = decimal.Context(prec=9)
+METRIC_LIMITS = {
+    field: 10.0 ** (RiskMetrics._meta.get_field(field).max_digits - 2) - 0.01
+    for field in ['volatility_30d', 'volatility_90d', 'max_drawdown', 'sharpe_ratio', 'value_at_risk']
+}
+
+def _to_decimal(value, field):
+    """
+    Convert a float metric straight to a 2dp Decimal (no str() round-trip),
+    clamped to the range of its column (e.g. the Sharpe ratio of an almost
+    riskless series); NaN is stored as 0
+    """
+    limit = METRIC_LIMITS[field]
+    value = 0.0 if math.isnan(value) else min(max(value, -limit), limit)
+    return Decimal.from_float(value).quantize(Q2, context=Q2_CTX)
+
+# portfolio_id -> (earliest, latest) snapshot timestamps in the 90-day window the
+# metrics were last computed for (per process, the portfolio computed longest ago
+# is dropped first; the lock guards the update against threaded/gevent workers)
+_last_computed = OrderedDict()
+_last_computed_lock = threading.Lock()
+LAST_COMPUTED_MAX_SIZE = 4096
+
 class RiskAnalysisService:
     """Service for calculating portfolio risk metrics"""
     
+    @staticmethod
+    def _compute_risk_numpy(values, rf_daily):
+        """
+        NumPy implementation of the risk metrics kernel
+        Returns tuple: (n_returns, volatility_30d, volatility_90d, max_drawdown, sharpe_ratio, var_95)
+        """
+        # Calculate daily log returns (days touching a zero value come out
+        # non-finite and are dropped)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            returns_array = np.diff(np.log(values))
+        returns_array = returns_array[np.isfinite(returns_array)]
+        
+        if len(returns_array) < 5:
+            return len(returns_array), 0.0, 0.0, 0.0, 0.0, 0.0
+        
+        # Calculate volatility (standard deviation of returns)
+        std_all = float(returns_array.std())
+        volatility_30d = float(returns_array[-30:].std()) * 100.0 if len(returns_array) >= 30 else std_all * 100.0
+        volatility_90d = std_all * 100.0
+        
+        # Calculate max drawdown (value / peak computed in place in the peak buffer;
+        # days before the first positive peak, e.g. a new empty portfolio, have no drawdown)
+        rolling_max = np.maximum.accumulate(values)
+        positive = rolling_max > 0
+        np.divide(values, rolling_max, out=rolling_max, where=positive)
+        rolling_max[~positive] = 1.0
+        max_drawdown = 100.0 * (1.0 - float(rolling_max.min()))
+        
+        # Calculate Sharpe ratio
+        mean_return = float(returns_array.mean())
+        if std_all > 0:
+            sharpe_ratio = (mean_return - rf_daily) / std_all * math.sqrt(365)
+        else:
+            sharpe_ratio = 0.0
+        
+        # Calculate 95% Value at Risk (VaR)
+        k = max(0, int(0.05 * returns_array.size))
+        var_95 = abs(float(np.partition(returns_array, k)[k]) * 100.0)
+        
+        return len(returns_array), volatility_30d, volatility_90d, max_drawdown, sharpe_ratio, var_95
+    
+    @staticmethod
+    def _load_snapshots(snapshots):
+        """
+        Ordered snapshot values as a tuple of floats
+        (hashable, so it can key the metrics cache)
+        """
+        return tuple(map(float, snapshots.order_by('timestamp').values_list('total_value_usd', flat=True)))
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _compute_metrics(values):
+        """
+        Memoized risk metrics for a tuple of ordered portfolio values
+        Returns tuple: (n_returns, volatility_30d, volatility_90d, max_drawdown, sharpe_ratio, var_95)
+        """
+        values_arr = np.array(values, dtype=np.float64)
+        compute = compute_risk if compute_risk is not None else RiskAnalysisService._compute_risk_numpy
+        return compute(values_arr, DAILY_RISK_FREE_RATE)
+    
+    @staticmethod
+    def _persist(portfolio, metrics):
+        """
+        Write the metric columns with a single UPDATE, creating the row only
+        when none exists yet
+        """
+        # QuerySet.update() doesn't apply auto_now
+        updated = RiskMetrics.objects.filter(portfolio_id=portfolio.id).update(
+            last_updated=timezone.now(), **metrics
+        )
+        if updated == 0:
+            RiskMetrics.objects.create(portfolio=portfolio, **metrics)
+    
     @classmethod
     def calculate_portfolio_risk_metrics(cls, portfolio_id):
         """Calculate and update risk metrics for a portfolio"""
         try:
-            # Get the portfolio
-            portfolio = Portfolio.objects.get(id=portfolio_id)
-            
-            # Get risk metrics object
-            risk_metrics, created = RiskMetrics.objects.get_or_create(portfolio=portfolio)
+            # Get the portfolio (and its risk metrics row, if any, in the same query)
+            portfolio = Portfolio.objects.select_related('risk_metrics').get(id=portfolio_id)
+        except Portfolio.DoesNotExist:
+            return False, "Portfolio not found"
+        risk_metrics = getattr(portfolio, 'risk_metrics', None)
+        
+        # Get historical data for the last 90 days
+        ninety_days_ago = timezone.now() - timedelta(days=90)
+        snapshots = PortfolioSnapshot.objects.filter(
+            portfolio=portfolio,
+            timestamp__gte=ninety_days_ago
+        )
+        
+        try:
+            # Skip the work if the window holds the same snapshots as last time
+            # (the earliest one changes as old snapshots fall out of the window)
+            bounds = snapshots.aggregate(earliest=Min('timestamp'), latest=Max('timestamp'))
+            window = (bounds['earliest'], bounds['latest'])
+            latest = bounds['latest']
+            if (
+                latest is not None
+                and _last_computed.get(portfolio.id) == window
+                and risk_metrics is not None
+                and risk_metrics.last_updated >= latest
+            ):
+                return True, "Risk metrics already up to date"
             
-            # Get historical data for the last 90 days
-            ninety_days_ago = datetime.now() - timedelta(days=90)
-            snapshots = PortfolioSnapshot.objects.filter(
-                portfolio=portfolio,
-                timestamp__gte=ninety_days_ago
-            ).order_by('timestamp')
+            values = cls._load_snapshots(snapshots)
+        except DatabaseError as e:
+            return False, f"Error loading portfolio snapshots: {str(e)}"
+        
+        # Need enough data for meaningful calculations
+        if len(values) < 7:  # Need at least a week of data
+            return False, "Not enough historical data for risk calculations"
+        
+        # Calculate the metrics (compiled kernel when available)
+        (
+            n_returns, volatility_30d, volatility_90d,
+            max_drawdown, sharpe_ratio, var_95
+        ) = cls._compute_metrics(values)
+        
+        if n_returns < 5:
+            return False, "Not enough return data for risk calculations"
+        
+        # Update risk metrics
+        metrics = {
+            'volatility_30d': _to_decimal(volatility_30d, 'volatility_30d'),
+            'volatility_90d': _to_decimal(volatility_90d, 'volatility_90d'),
+            'max_drawdown': _to_decimal(max_drawdown, 'max_drawdown'),
+            'sharpe_ratio': _to_decimal(sharpe_ratio, 'sharpe_ratio'),
+            'value_at_risk': _to_decimal(var_95, 'value_at_risk'),
+        }
+        try:
+            cls._persist(portfolio, metrics)
+        except DatabaseError as e:
+            return False, f"Error saving risk metrics: {str(e)}"
+        with _last_computed_lock:
+            _last_computed[portfolio.id] = window
+            _last_computed.move_to_end(portfolio.id)
+            if len(_last_computed) > LAST_COMPUTED_MAX_SIZE:
+                _last_computed.popitem(last=False)
+        
+        return True, "Risk metrics updated successfully"
+    
+    @classmethod
+    def bulk_calculate_risk_metrics(cls, portfolio_ids):
+        """
+        Calculate and update risk metrics for many portfolios at once (e.g. from a
+        periodic job). Snapshots for all portfolios are fetched in one query and
+        the metrics are computed with NumPy reductions over a (portfolios, days)
+        array padded with NaN.
+        portfolio_ids may be a queryset (e.g. Portfolio.objects.values('id')),
+        which is then filtered as a subquery instead of binding every id.
+        Returns tuple: (success_bool, message)
+        """
+        # Get historical data for the last 90 days, grouped by portfolio
+        ninety_days_ago = timezone.now() - timedelta(days=90)
+        try:
+            # Streamed in chunks straight into one structured array (no row tuples kept around)
+            rows = np.fromiter(
+                PortfolioSnapshot.objects.filter(
+                    portfolio_id__in=portfolio_ids,
+                    timestamp__gte=ninety_days_ago
+                ).order_by('portfolio_id', 'timestamp').values_list(
+                    'portfolio_id', 'total_value_usd'
+                ).iterator(chunk_size=2000),
+                dtype=[('portfolio_id', np.int64), ('total_value_usd', np.float64)]
+            )
+        except DatabaseError as e:
+            return False, f"Error loading portfolio snapshots: {str(e)}"
+        
+        if not len(rows):
+            return False, "Not enough historical data for risk calculations"
+        
+        row_ids = rows['portfolio_id']
+        row_values = rows['total_value_usd']
+        
+        # Rows are ordered by portfolio, so a row's column is its offset in the group
+        ids, inverse, counts = np.unique(row_ids, return_inverse=True, return_counts=True)
+        columns = np.arange(len(rows)) - (np.cumsum(counts) - counts)[inverse]
+        values = np.full((len(ids), counts.max()), np.nan)
+        values[inverse, columns] = row_values
+        
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Daily log returns (NaN for padding and days touching a zero value)
+            returns = np.diff(np.log(values), axis=1)
+            valid = np.isfinite(returns)
+            returns[~valid] = np.nan
+            n_returns = valid.sum(axis=1)
             
-            # Need enough data for meaningful calculations
-            if snapshots.count() < 7:  # Need at least a week of data
+            # Need at least a week of data and enough returns
+            eligible = (counts >= 7) & (n_returns >= 5)
+            if not eligible.any():
                 return False, "Not enough historical data for risk calculations"
+            ids, values, n_returns = ids[eligible], values[eligible], n_returns[eligible]
             
-            # Extract values and calculate daily returns
-            values = [float(snapshot.total_value_usd) for snapshot in snapshots]
-            returns = []
-            
-            for i in range(1, len(values)):
-                if values[i-1] > 0:  # Avoid division by zero
-                    daily_return = (values[i] - values[i-1]) / values[i-1]
-                    returns.append(daily_return)
+            # Pack each row's valid returns to the left, keeping their order
+            order = np.argsort(~valid[eligible], axis=1, kind='stable')
+            returns = np.take_along_axis(returns[eligible], order, axis=1)
             
-            if len(returns) < 5:
-                return False, "Not enough return data for risk calculations"
+            # Volatility over all returns and over the most recent 30
+            std_all = np.nanstd(returns, axis=1)
+            recent = np.arange(returns.shape[1]) >= (n_returns - 30)[:, None]
+            volatility_30d = np.nanstd(np.where(recent, returns, np.nan), axis=1) * 100.0
+            volatility_90d = std_all * 100.0
             
-            # Convert to numpy array for calculations
-            returns_array = np.array(returns)
+            # Max drawdown from the running peak (fmax skips the NaN padding),
+            # with value / peak computed in place in the peak buffer
+            rolling_max = np.fmax.accumulate(values, axis=1)
+            np.divide(values, rolling_max, out=rolling_max)
+            max_drawdown = 100.0 * (1.0 - np.nanmin(rolling_max, axis=1))
             
-            # Calculate volatility (standard deviation of returns)
-            volatility_30d = np.std(returns_array[-30:] if len(returns_array) >= 30 else returns_array) * 100
-            volatility_90d = np.std(returns_array) * 100
+            # Sharpe ratio
+            mean_return = np.nanmean(returns, axis=1)
+            sharpe_ratio = np.where(
+                std_all > 0,
+                (mean_return - DAILY_RISK_FREE_RATE) / std_all * math.sqrt(365),
+                0.0
+            )
             
-            # Calculate max drawdown
-            rolling_max = np.maximum.accumulate(values)
-            drawdowns = (rolling_max - values) / rolling_max
-            max_drawdown = 100 * np.max(drawdowns)
-            
-            # Calculate Sharpe ratio (assuming risk-free rate of 2%)
-            risk_free_rate = 0.02 / 365  # Daily risk-free rate
-            mean_return = np.mean(returns_array)
-            if np.std(returns_array) > 0:
-                sharpe_ratio = (mean_return - risk_free_rate) / np.std(returns_array) * np.sqrt(365)
+            # 95% VaR: k-th smallest return per row (NaN sorts last)
+            k = (0.05 * n_returns).astype(np.int64)
+            var_95 = np.abs(np.sort(returns, axis=1)[np.arange(len(ids)), k] * 100.0)
+        
+        # Persist in batches
+        fields = ['volatility_30d', 'volatility_90d', 'max_drawdown', 'sharpe_ratio', 'value_at_risk']
+        try:
+            existing = {
+                risk_metrics.portfolio_id: risk_metrics
+                for risk_metrics in RiskMetrics.objects.filter(portfolio_id__in=portfolio_ids)
+            }
+        except DatabaseError as e:
+            return False, f"Error loading risk metrics: {str(e)}"
+        now = timezone.now()
+        to_create = []
+        to_update = []
+        for i, portfolio_id in enumerate(ids.tolist()):
+            risk_metrics = existing.get(portfolio_id)
+            if risk_metrics is None:
+                risk_metrics = RiskMetrics(portfolio_id=portfolio_id)
+                to_create.append(risk_metrics)
             else:
-                sharpe_ratio = 0
-            
-            # Calculate 95% Value at Risk (VaR)
-            var_95 = abs(np.percentile(returns_array, 5) * 100)
-            
-            # Update risk metrics
-            risk_metrics.volatility_30d = Decimal(str(volatility_30d))
-            risk_metrics.volatility_90d = Decimal(str(volatility_90d))
-            risk_metrics.max_drawdown = Decimal(str(max_drawdown))
-            risk_metrics.sharpe_ratio = Decimal(str(sharpe_ratio))
-            risk_metrics.value_at_risk = Decimal(str(var_95))
-            risk_metrics.save()
-            
-            return True, "Risk metrics updated successfully"
-            
-        except Portfolio.DoesNotExist:
-            return False, "Portfolio not found"
-        except Exception as e:
-            return False, f"Error calculating risk metrics: {str(e)}"
\ No newline at end of file
+                to_update.append(risk_metrics)
+            risk_metrics.volatility_30d = _to_decimal(volatility_30d[i], 'volatility_30d')
+            risk_metrics.volatility_90d = _to_decimal(volatility_90d[i], 'volatility_90d')
+            risk_metrics.max_drawdown = _to_decimal(max_drawdown[i], 'max_drawdown')
+            risk_metrics.sharpe_ratio = _to_decimal(sharpe_ratio[i], 'sharpe_ratio')
+            risk_metrics.value_at_risk = _to_decimal(var_95[i], 'value_at_risk')
+            # bulk_update() doesn't apply auto_now
+            risk_metrics.last_updated = now
+        
+        try:
+            with transaction.atomic():
+                RiskMetrics.objects.bulk_create(to_create)
+                RiskMetrics.objects.bulk_update(to_update, [*fields, 'last_updated'])
+        except DatabaseError as e:
+            return False, f"Error saving risk metrics: {str(e)}"
+        
+        return True, f"Risk metrics updated for {len(ids)} portfolios"
\ No newline at end of file
@@ -0,0 +1,409 @@
+# assets/tasks.py
+import asyncio
+import decimal
+import logging
+import numpy as np
+import pandas as pd
+from decimal import Decimal
+from datetime import datetime, timedelta
+from celery import shared_task
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+from wallets.models import Wallet
+from wallets.services import MoralisService
+from .models import Token, WalletToken, Transaction, Portfolio, PortfolioSnapshot, RiskMetrics
+from .services import RiskAnalysisService
+
+logger = logging.getLogger(__name__)
+
+# Wei per ether, and a context wide enough to divide by it exactly
+# (Transaction amounts are DecimalField(max_digits=36, decimal_places=18))
+WEI = Decimal(10) ** 18
+WEI_CTX = decimal.Context(prec=60)
+
+# A sync only adds a portfolio snapshot when the latest one is older than
+# this, or the value changed by more than SNAPSHOT_MIN_CHANGE (relative)
+SNAPSHOT_MIN_INTERVAL = timedelta(minutes=30)
+SNAPSHOT_MIN_CHANGE = Decimal('0.001')
+
+def _to_int(value):
+    """Integer wei amount from a Moralis string field (0 when missing or malformed)"""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+async def _fetch_wallet_data(client, wallet, force_refresh=False):
+    """
+    Fetch balance, tokens and recent transactions for one wallet from Moralis
+    (the three calls run concurrently, no database access)
+    Returns dict of (success_bool, data_or_error_message) per call
+    """
+    net_worth, tokens, transactions = await asyncio.gather(
+        MoralisService.aget_wallet_net_worth(client, wallet.address, wallet.chain, force_refresh=force_refresh),
+        MoralisService.aget_wallet_tokens(client, wallet.address, wallet.chain, force_refresh=force_refresh),
+        MoralisService.aget_wallet_transactions(client, wallet.address, wallet.chain, limit=100, force_refresh=force_refresh),
+    )
+    return {'net_worth': net_worth, 'tokens': tokens, 'transactions': transactions}
+
+async def _fetch_all_wallets(wallets, force_refresh=False):
+    """
+    Fetch Moralis data for all wallets on one event loop
+    Returns list of per-wallet data dicts, in the order of wallets
+    """
+    async with MoralisService.async_client() as client:
+        return await asyncio.gather(*(
+            _fetch_wallet_data(client, wallet, force_refresh) for wallet in wallets
+        ))
+
+def _sync_one_wallet(wallet, data):
+    """
+    Store the fetched Moralis data for one wallet (the balance is only set on
+    the wallet, the caller saves it)
+    Returns dict of partial results, merged into the sync response by the caller
+    """
+    results = {
+        'wallets_synced': 0,
+        'tokens_synced': 0,
+        'transactions_synced': 0,
+        'failed_syncs': []
+    }
+    
+    # Sync wallet balance (using existing method)
+    try:
+        success, result = data['net_worth']
+        if success and isinstance(result, dict):
+            chains = result.get('chains', [])
+            chain_data = next((c for c in chains if c.get('chain') == wallet.chain), None)
+            
+            if chain_data:
+                balance_value = chain_data.get('balance_usd', 0)
+                if not balance_value and 'networth_usd' in chain_data:
+                    balance_value = chain_data.get('networth_usd', 0)
+                
+                # Saved in one bulk_update by the caller
+                wallet.balance_usd = balance_value
+                wallet.synced_at = timezone.now()
+                results['wallets_synced'] += 1
+    except Exception as e:
+        logger.exception("Error syncing wallet balance: %s", e)
+        results['failed_syncs'].append(f"Balance for {wallet.address}: {str(e)}")
+    
+    # Sync tokens
+    try:
+        success, token_data = data['tokens']
+        if success and isinstance(token_data, dict) and 'tokens' in token_data:
+            # Load the token rows into a DataFrame (missing fields come out as NaN)
+            df = pd.DataFrame(token_data['tokens']).reindex(
+                columns=['symbol', 'token_address', 'name', 'logo', 'usd_price', 'decimals', 'balance']
+            )
+            df['name'] = df['name'].fillna(df['symbol']).fillna('Unknown Token')
+            df['symbol'] = df['symbol'].fillna('UNKNOWN')
+            
+            # Vectorized balance and USD value (raw balance scaled by the token decimals)
+            decimals = pd.to_numeric(df['decimals'], errors='coerce').fillna(18)
+            df['balance'] = pd.to_numeric(df['balance'], errors='coerce').fillna(0).astype('float64') / np.power(10.0, decimals)
+            df['balance_usd'] = df['balance'] * pd.to_numeric(df['usd_price'], errors='coerce').fillna(0)
+            
+            # Duplicates in the response collapse onto their last row, NaN becomes None for the ORM
+            df = df.drop_duplicates(['symbol', 'token_address'], keep='last')
+            df = df.astype(object).where(df.notna(), None)
+            
+            # Build the token and balance rows, keyed on (symbol, contract address)
+            tokens = {}
+            balances = {}
+            for row in df.itertuples(index=False):
+                key = (row.symbol, row.token_address)
+                tokens[key] = Token(
+                    symbol=row.symbol,
+                    chain=wallet.chain,
+                    contract_address=row.token_address,
+                    name=row.name,
+                    logo_url=row.logo or None,
+                    current_price_usd=row.usd_price,
+                )
+                balances[key] = (row.balance, row.balance_usd)
+            
+            # Upsert the tokens in one statement (sets pk on each object). A NULL
+            # contract address never conflicts, so those go through update_or_create.
+            Token.objects.bulk_create(
+                [token for token in tokens.values() if token.contract_address is not None],
+                update_conflicts=True,
+                unique_fields=['symbol', 'chain', 'contract_address'],
+                update_fields=['name', 'logo_url', 'current_price_usd', 'price_updated_at'],
+                batch_size=500
+            )
+            for key, token in tokens.items():
+                if token.contract_address is None:
+                    tokens[key], _ = Token.objects.update_or_create(
+                        symbol=token.symbol,
+                        chain=token.chain,
+                        contract_address=None,
+                        defaults={
+                            'name': token.name,
+                            'logo_url': token.logo_url,
+                            'current_price_usd': token.current_price_usd,
+                        }
+                    )
+            
+            # Upsert the wallet token balances
+            wallet_tokens = [
+                WalletToken(wallet=wallet, token=tokens[key], balance=balance, balance_usd=balance_usd)
+                for key, (balance, balance_usd) in balances.items()
+            ]
+            WalletToken.objects.bulk_create(
+                wallet_tokens,
+                update_conflicts=True,
+                unique_fields=['wallet', 'token'],
+                update_fields=['balance', 'balance_usd', 'last_synced'],
+                batch_size=500
+            )
+            
+            results['tokens_synced'] += len(wallet_tokens)
+    except Exception as e:
+        logger.exception("Error syncing tokens: %s", e)
+        results['failed_syncs'].append(f"Tokens for {wallet.address}: {str(e)}")
+    
+    # Sync transactions (limited to recent ones)
+    try:
+        success, tx_data = data['transactions']
+        if success and isinstance(tx_data, dict) and 'result' in tx_data:
+            # Load the transaction rows into a DataFrame (missing fields come out as NaN)
+            df = pd.DataFrame(tx_data['result']).reindex(columns=[
+                'hash', 'block_number', 'block_timestamp', 'from_address', 'to_address',
+                'value', 'gas_price', 'receipt_gas_used', 'receipt_status'
+            ])
+            
+            # Parse the ISO-8601 block timestamps in one call, dropping rows that can't be stored
+            # (format='ISO8601' so rows with and without fractional seconds both parse)
+            df['timestamp'] = pd.to_datetime(df['block_timestamp'], utc=True, format='ISO8601', errors='coerce')
+            invalid = df['hash'].isna() | df['timestamp'].isna()
+            if invalid.any():
+                logger.warning("Skipping %s malformed transactions for %s", int(invalid.sum()), wallet.address)
+                df = df[~invalid]
+            df = df.drop_duplicates('hash', keep='last')
+            
+            # Wei amounts as exact integers, converted to ether as Decimal (the
+            # columns are DecimalField, float would lose the low digits)
+            df['block_number'] = pd.to_numeric(df['block_number'], errors='coerce').fillna(0).astype('int64')
+            df['gas_price'] = df['gas_price'].map(_to_int)
+            df['gas_used'] = df['receipt_gas_used'].map(_to_int)
+            df['value_eth'] = [WEI_CTX.divide(Decimal(value), WEI) for value in df['value'].map(_to_int)]
+            df['fee'] = [
+                WEI_CTX.divide(Decimal(gas_used * gas_price), WEI)
+                for gas_used, gas_price in zip(df['gas_used'], df['gas_price'])
+            ]
+            
+            # Determine transaction types (astype(str) so the .str accessor also
+            # works on an empty or all-NaN column, which pandas types as float)
+            df['from_address'] = df['from_address'].fillna('').astype(str)
+            df['to_address'] = df['to_address'].fillna('').astype(str)
+            wallet_address = wallet.address.lower()
+            df['tx_type'] = np.where(
+                df['from_address'].str.lower() == wallet_address, 'send',
+                np.where(df['to_address'].str.lower() == wallet_address, 'receive', 'unknown')
+            )
+            
+            # Build the transaction rows
+            transactions = [
+                Transaction(
+                    wallet=wallet,
+                    transaction_hash=row.hash,
+                    block_number=row.block_number,
+                    timestamp=row.timestamp.to_pydatetime(),
+                    from_address=row.from_address,
+                    to_address=row.to_address,
+                    value=row.value_eth,
+                    gas_price=row.gas_price,
+                    gas_used=row.gas_used,
+                    transaction_fee=row.fee,
+                    transaction_type=row.tx_type,
+                    status=row.receipt_status == '1'
+                )
+                for row in df.itertuples(index=False)
+            ]
+            
+            # Upsert all transactions in one statement
+            Transaction.objects.bulk_create(
+                transactions,
+                update_conflicts=True,
+                unique_fields=['wallet', 'transaction_hash'],
+                update_fields=[
+                    'block_number', 'timestamp', 'from_address', 'to_address', 'value',
+                    'gas_price', 'gas_used', 'transaction_fee', 'transaction_type', 'status'
+                ],
+                batch_size=500
+            )
+            results['transactions_synced'] += len(transactions)
+    except Exception as e:
+        logger.exception("Error syncing transactions: %s", e)
+        results['failed_syncs'].append(f"Transactions for {wallet.address}: {str(e)}")
+    
+    return results
+
+@shared_task
+def sync_user_wallets(user_id, force_refresh=False):
+    """
+    Synchronize all wallet data for a user (balances, tokens, transactions,
+    then the portfolio value, snapshot and concentration risk)
+    Returns dict of sync results
+    """
+    # Get all wallets for this user
+    wallets = Wallet.objects.filter(users=user_id).only('id', 'address', 'chain', 'balance_usd')
+    
+    # Track successfully synced wallets
+    results = {
+        'wallets_synced': 0,
+        'tokens_synced': 0,
+        'transactions_synced': 0,
+        'failed_syncs': []
+    }
+    
+    # Fetch Moralis data for all wallets concurrently (the calls are network bound),
+    # then write each wallet's rows (the ORM stays outside the event loop)
+    wallet_list = list(wallets)
+    to_update = []
+    for wallet, data in zip(wallet_list, asyncio.run(_fetch_all_wallets(wallet_list, force_refresh))):
+        wallet_results = _sync_one_wallet(wallet, data)
+        if wallet_results['wallets_synced']:
+            to_update.append(wallet)
+        results['wallets_synced'] += wallet_results['wallets_synced']
+        results['tokens_synced'] += wallet_results['tokens_synced']
+        results['transactions_synced'] += wallet_results['transactions_synced']
+        results['failed_syncs'].extend(wallet_results['failed_syncs'])
+    
+    # Save the synced wallet balances in one go
+    try:
+        Wallet.objects.bulk_update(to_update, ['balance_usd', 'synced_at'], batch_size=200)
+    except Exception as e:
+        logger.exception("Error saving wallet balances: %s", e)
+        results['failed_syncs'].append(f"Wallet balances: {str(e)}")
+        results['wallets_synced'] = 0
+    
+    # Update portfolio data
+    try:
+        portfolio, created = Portfolio.objects.get_or_create(user_id=user_id)
+        
+        # Calculate current portfolio value (summed in the database)
+        total_value = WalletToken.objects.filter(wallet__in=wallets).aggregate(
+            total=Sum('balance_usd')
+        )['total'] or 0
+        
+        # Seed unset previous day/week/month values, e.g. for a new portfolio (from then
+        # on roll_portfolio_windows keeps them current)
+        update_fields = [
+            'total_value_usd', 'all_time_high_usd', 'all_time_high_date',
+            'all_time_low_usd', 'all_time_low_date', 'last_updated'
+        ]
+        for field in ['previous_day_value_usd', 'previous_week_value_usd', 'previous_month_value_usd']:
+            if getattr(portfolio, field) is None:
+                setattr(portfolio, field, total_value)
+                update_fields.append(field)
+        
+        # Update ATH/ATL if needed
+        today = datetime.now().date()
+        if created or portfolio.all_time_high_usd is None or total_value > portfolio.all_time_high_usd:
+            portfolio.all_time_high_usd = total_value
+            portfolio.all_time_high_date = today
+        
+        if created or portfolio.all_time_low_usd is None or total_value < portfolio.all_time_low_usd:
+            portfolio.all_time_low_usd = total_value
+            portfolio.all_time_low_date = today
+        
+        portfolio.total_value_usd = total_value
+        portfolio.save(update_fields=update_fields)
+        
+        # Create portfolio snapshot, unless the latest one is recent and the value
+        # has barely moved (keeps the snapshot range scans small)
+        last = PortfolioSnapshot.objects.filter(portfolio=portfolio).order_by('-timestamp').only(
+            'timestamp', 'total_value_usd'
+        ).first()
+        if (
+            last is None
+            or timezone.now() - last.timestamp > SNAPSHOT_MIN_INTERVAL
+            or abs(last.total_value_usd - total_value) / max(total_value, 1) > SNAPSHOT_MIN_CHANGE
+        ):
+            PortfolioSnapshot.objects.create(
+                portfolio=portfolio,
+                total_value_usd=total_value
+            )
+        
+        # Update risk metrics (calculate on sync)
+        risk_metrics, _ = RiskMetrics.objects.get_or_create(portfolio=portfolio)
+        
+        # Calculate concentration risk (% in top asset), the largest per-symbol
+        # position comes straight from the database
+        largest_position = (
+            WalletToken.objects.filter(wallet__in=wallets)
+            .values('token__symbol')
+            .annotate(value=Sum('balance_usd'))
+            .order_by(F('value').desc(nulls_last=True))
+            .values_list('value', flat=True)
+            .first()
+        )
+        if largest_position is not None and total_value > 0:
+            risk_metrics.concentration_risk = (largest_position / total_value) * 100
+        
+        # Save risk metrics
+        risk_metrics.save(update_fields=['concentration_risk', 'last_updated'])
+        
+    except Exception as e:
+        logger.exception("Error updating portfolio data: %s", e)
+        results['failed_syncs'].append(f"Portfolio update: {str(e)}")
+    
+    return results
+
+@shared_task
+def roll_portfolio_windows():
+    """
+    Refresh every portfolio's previous day/week/month value from its snapshots
+    (the earliest snapshot inside each window), so the portfolio view only
+    reads them. Scheduled nightly via CELERY_BEAT_SCHEDULE.
+    Returns number of portfolios updated
+    """
+    now = timezone.now()
+    
+    def value_since(days, field):
+        # Earliest snapshot value in the window (served by the (portfolio, timestamp) index),
+        # keeping the current value when the window has no snapshots
+        return Coalesce(
+            Subquery(
+                PortfolioSnapshot.objects.filter(
+                    portfolio=OuterRef('pk'),
+                    timestamp__gte=now - timedelta(days=days)
+                ).order_by('timestamp').values('total_value_usd')[:1]
+            ),
+            F(field)
+        )
+    
+    portfolios = list(Portfolio.objects.only('id').annotate(
+        day_value=value_since(1, 'previous_day_value_usd'),
+        week_value=value_since(7, 'previous_week_value_usd'),
+        month_value=value_since(30, 'previous_month_value_usd'),
+    ))
+    for portfolio in portfolios:
+        portfolio.previous_day_value_usd = portfolio.day_value
+        portfolio.previous_week_value_usd = portfolio.week_value
+        portfolio.previous_month_value_usd = portfolio.month_value
+    
+    Portfolio.objects.bulk_update(
+        portfolios,
+        ['previous_day_value_usd', 'previous_week_value_usd', 'previous_month_value_usd'],
+        batch_size=500
+    )
+    return len(portfolios)
+
+@shared_task
+def refresh_risk_metrics():
+    """
+    Recalculate risk metrics for every portfolio in one pass (one snapshot
+    query, vectorized over all portfolios). Scheduled nightly via
+    CELERY_BEAT_SCHEDULE.
+    Returns result message
+    """
+    # A subquery rather than a list of ids, which could exceed SQLite's bound-variable limit
+    success, message = RiskAnalysisService.bulk_calculate_risk_metrics(Portfolio.objects.values('id'))
+    if not success:
+        logger.warning("Risk metrics refresh failed: %s", message)
+    return message
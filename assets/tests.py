@@ -1,154 +1,333 @@
-# assets/models.py
-from django.db import models
-from wallets.models import Wallet
+# assets/tests.py
+import random
+import unittest
+from unittest import mock
+import numpy as np
+from decimal import Decimal
+from datetime import timedelta
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
-from django.conf import settings
+from rest_framework.test import APIClient
+from wallets.models import Wallet, WalletUser
+from .models import Portfolio, PortfolioSnapshot, RiskMetrics, Token, Transaction, WalletToken
+from .services import DAILY_RISK_FREE_RATE, RiskAnalysisService, compute_risk
+from .tasks import _sync_one_wallet, refresh_risk_metrics, roll_portfolio_windows, sync_user_wallets
 
 
-class Token(models.Model):
-    """Model for tracking crypto tokens/coins"""
-    symbol = models.CharField(max_length=20)
-    name = models.CharField(max_length=100)
-    logo_url = models.URLField(null=True, blank=True)
-    contract_address = models.CharField(max_length=255, null=True, blank=True)
-    chain = models.CharField(max_length=50)
-    coingecko_id = models.CharField(max_length=100, null=True, blank=True)
-    
-    # Current price data
-    current_price_usd = models.DecimalField(max_digits=24, decimal_places=12, null=True, blank=True)
-    price_updated_at = models.DateTimeField(auto_now=True)
-    market_cap = models.DecimalField(max_digits=36, decimal_places=2, null=True, blank=True)
-    
-    # 24h change metrics
-    price_change_24h = models.DecimalField(max_digits=7, decimal_places=2, null=True, blank=True)
-    volume_24h = models.DecimalField(max_digits=36, decimal_places=2, null=True, blank=True)
-    
-    class Meta:
-        unique_together = ('symbol', 'chain', 'contract_address')
-    
-    def __str__(self):
-        return f"{self.symbol} ({self.chain})"
+@unittest.skipIf(compute_risk is None, "numba kernel not available")
+class RiskKernelTests(TestCase):
+    """The compiled kernel and the NumPy fallback must give the same metrics"""
+    
+    def assertKernelsAgree(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        compiled = compute_risk(values.copy(), DAILY_RISK_FREE_RATE)
+        fallback = RiskAnalysisService._compute_risk_numpy(values.copy(), DAILY_RISK_FREE_RATE)
+        self.assertEqual(compiled[0], fallback[0])
+        np.testing.assert_allclose(compiled[1:], fallback[1:], rtol=1e-9, atol=1e-9)
+    
+    def test_random_walk(self):
+        rng = np.random.default_rng(0)
+        for n in (7, 31, 90):
+            self.assertKernelsAgree(1000 * np.cumprod(1 + rng.normal(0, 0.03, n)))
+    
+    def test_leading_zero_snapshots(self):
+        # A new portfolio starts with zero-value snapshots
+        values = [0, 0, 0, 100, 80, 90, 75, 95, 110, 100]
+        self.assertKernelsAgree(values)
+        self.assertAlmostEqual(RiskAnalysisService._compute_risk_numpy(np.array(values, dtype=np.float64), 0.0)[3], 25.0)
+    
+    def test_zero_in_the_middle(self):
+        self.assertKernelsAgree([100, 110, 0, 120, 115, 130, 125, 140, 150])
+    
+    def test_flat_series(self):
+        self.assertKernelsAgree([100] * 10)
 
-class WalletToken(models.Model):
-    """Model for tracking token balances within wallets"""
-    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='tokens')
-    token = models.ForeignKey(Token, on_delete=models.CASCADE)
-    balance = models.DecimalField(max_digits=36, decimal_places=18)
-    balance_usd = models.DecimalField(max_digits=18, decimal_places=2, null=True, blank=True)
-    last_synced = models.DateTimeField(auto_now=True)
-    
-    class Meta:
-        unique_together = ('wallet', 'token')
-    
-    def __str__(self):
-        return f"{self.wallet} - {self.token}: {self.balance}"
 
-class TokenPrice(models.Model):
-    """Model for tracking historical token prices"""
-    token = models.ForeignKey(Token, on_delete=models.CASCADE, related_name='price_history')
-    price_usd = models.DecimalField(max_digits=24, decimal_places=12)
-    timestamp = models.DateTimeField()
-    
-    class Meta:
-        unique_together = ('token', 'timestamp')
-        indexes = [
-            models.Index(fields=['token', 'timestamp']),
-        ]
-    
-    def __str__(self):
-        return f"{self.token} - ${self.price_usd} at {self.timestamp}"
+class RiskMetricsRangeTests(TestCase):
+    """Metrics outside a column's range are clamped rather than failing the save"""
+    
+    def test_sharpe_ratio_is_clamped(self):
+        # A smooth geometric series has almost no volatility, so its Sharpe ratio
+        # is far beyond what the column holds
+        user = get_user_model().objects.create_user(email='smooth@example.com', password='x')
+        portfolio = Portfolio.objects.create(user=user)
+        now = timezone.now()
+        PortfolioSnapshot.objects.bulk_create([
+            PortfolioSnapshot(
+                portfolio=portfolio,
+                total_value_usd=Decimal(f'{100 * 1.01 ** day:.2f}'),
+                timestamp=now - timedelta(days=30 - day, hours=1)
+            )
+            for day in range(30)
+        ])
+        
+        success, _ = RiskAnalysisService.calculate_portfolio_risk_metrics(portfolio.id)
+        self.assertTrue(success)
+        self.assertEqual(RiskMetrics.objects.get(portfolio=portfolio).sharpe_ratio, Decimal('999.99'))
+        
+        RiskMetrics.objects.all().delete()
+        success, _ = RiskAnalysisService.bulk_calculate_risk_metrics([portfolio.id])
+        self.assertTrue(success)
+        self.assertEqual(RiskMetrics.objects.get(portfolio=portfolio).sharpe_ratio, Decimal('999.99'))
 
-class Portfolio(models.Model):
-    """Model for tracking portfolio performance metrics"""
-    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='portfolio')
-    total_value_usd = models.DecimalField(max_digits=18, decimal_places=2, default=0)
-    previous_day_value_usd = models.DecimalField(max_digits=18, decimal_places=2, null=True, blank=True)
-    previous_week_value_usd = models.DecimalField(max_digits=18, decimal_places=2, null=True, blank=True)
-    previous_month_value_usd = models.DecimalField(max_digits=18, decimal_places=2, null=True, blank=True)
-    all_time_high_usd = models.DecimalField(max_digits=18, decimal_places=2, null=True, blank=True)
-    all_time_high_date = models.DateField(null=True, blank=True)
-    all_time_low_usd = models.DecimalField(max_digits=18, decimal_places=2, null=True, blank=True)
-    all_time_low_date = models.DateField(null=True, blank=True)
-    last_updated = models.DateTimeField(auto_now=True)
-    
-    def __str__(self):
-        return f"Portfolio for {self.user.email}"
 
-class PortfolioSnapshot(models.Model):
-    """Model for tracking historical portfolio values"""
-    portfolio = models.ForeignKey(Portfolio, on_delete=models.CASCADE, related_name='snapshots')
-    total_value_usd = models.DecimalField(max_digits=18, decimal_places=2)
-    timestamp = models.DateTimeField(default=timezone.now)
-    
-    class Meta:
-        indexes = [
-            models.Index(fields=['portfolio', 'timestamp']),
-        ]
-    
-    def __str__(self):
-        return f"{self.portfolio} - ${self.total_value_usd} at {self.timestamp}"
+class BulkRiskMetricsTests(TestCase):
+    """The nightly bulk refresh must match the per-portfolio calculation"""
+    
+    METRICS = ['volatility_30d', 'volatility_90d', 'max_drawdown', 'sharpe_ratio', 'value_at_risk']
+    
+    def setUp(self):
+        rng = random.Random(1)
+        now = timezone.now()
+        self.portfolio_ids = []
+        # Different history lengths, one with a zero-value day, one too short
+        for i, days in enumerate([60, 20, 120, 4]):
+            user = get_user_model().objects.create_user(email=f'user{i}@example.com', password='x')
+            portfolio = Portfolio.objects.create(user=user)
+            self.portfolio_ids.append(portfolio.id)
+            value = 1000.0
+            snapshots = []
+            for day in range(days):
+                value *= 1 + rng.gauss(0.001, 0.03)
+                if i == 1 and day == 5:
+                    value = 0.0
+                elif i == 1 and day == 6:
+                    value = 500.0
+                snapshots.append(PortfolioSnapshot(
+                    portfolio=portfolio,
+                    total_value_usd=Decimal(f'{value:.2f}'),
+                    timestamp=now - timedelta(days=days - day, hours=1)
+                ))
+            PortfolioSnapshot.objects.bulk_create(snapshots)
+    
+    def metrics(self):
+        return {
+            risk_metrics.portfolio_id: [getattr(risk_metrics, field) for field in self.METRICS]
+            for risk_metrics in RiskMetrics.objects.all()
+        }
+    
+    def test_bulk_matches_single(self):
+        refresh_risk_metrics()
+        bulk = self.metrics()
+        
+        RiskMetrics.objects.all().delete()
+        for portfolio_id in self.portfolio_ids:
+            RiskAnalysisService.calculate_portfolio_risk_metrics(portfolio_id)
+        single = self.metrics()
+        
+        self.assertEqual(set(bulk), set(self.portfolio_ids[:3]))
+        self.assertEqual(set(bulk), set(single))
+        for portfolio_id in bulk:
+            for bulk_value, single_value in zip(bulk[portfolio_id], single[portfolio_id]):
+                self.assertAlmostEqual(bulk_value, single_value, delta=Decimal('0.01'))
+    
+    def test_refresh_does_not_bind_portfolio_ids(self):
+        # Refreshing everything filters by subquery, however many portfolios exist
+        with CaptureQueriesContext(connection) as queries:
+            refresh_risk_metrics()
+        self.assertEqual(RiskMetrics.objects.count(), 3)
+        for query in queries:
+            if ' IN (' in query['sql']:
+                self.assertIn(' IN (SELECT', query['sql'])
 
-class TransactionType(models.TextChoices):
-    RECEIVE = 'receive', 'Receive'
-    SEND = 'send', 'Send'
-    SWAP = 'swap', 'Swap'
-    LIQUIDITY = 'liquidity', 'Liquidity'
-    STAKE = 'stake', 'Stake'
-    UNSTAKE = 'unstake', 'Unstake'
-    EARN = 'earn', 'Earn Rewards'
-    FEE = 'fee', 'Fee'
-    UNKNOWN = 'unknown', 'Unknown'
 
-class Transaction(models.Model):
-    """Model for tracking blockchain transactions"""
-    wallet = models.ForeignKey(Wallet, on_delete=models.CASCADE, related_name='transactions')
-    transaction_hash = models.CharField(max_length=255)
-    block_number = models.PositiveBigIntegerField()
-    timestamp = models.DateTimeField()
-    from_address = models.CharField(max_length=255)
-    to_address = models.CharField(max_length=255)
-    value = models.DecimalField(max_digits=36, decimal_places=18, default=0)
-    gas_price = models.DecimalField(max_digits=36, decimal_places=18, default=0)
-    gas_used = models.PositiveBigIntegerField(default=0)
-    transaction_fee = models.DecimalField(max_digits=36, decimal_places=18, default=0)
-    transaction_type = models.CharField(
-        max_length=20, 
-        choices=TransactionType.choices,
-        default=TransactionType.UNKNOWN
-    )
-    status = models.BooleanField(default=True)  # True if successful
-    
-    class Meta:
-        unique_together = ('wallet', 'transaction_hash')
-        indexes = [
-            models.Index(fields=['wallet', 'timestamp']),
-        ]
-    
-    def __str__(self):
-        return f"{self.transaction_hash} ({self.transaction_type})"
+class TransactionSyncTests(TestCase):
+    """Transaction responses without usable rows sync nothing, without failing"""
+    
+    def setUp(self):
+        self.wallet = Wallet.objects.create(address='0xAbC0000000000000000000000000000000000001', chain='eth')
+    
+    def sync_transactions(self, rows):
+        return _sync_one_wallet(self.wallet, {
+            'net_worth': (False, "skipped"),
+            'tokens': (False, "skipped"),
+            'transactions': (True, {'result': rows}),
+        })
+    
+    def test_empty_response(self):
+        results = self.sync_transactions([])
+        self.assertEqual(results['failed_syncs'], [])
+        self.assertEqual(results['transactions_synced'], 0)
+    
+    def test_all_malformed_response(self):
+        with self.assertLogs('assets.tasks', 'WARNING'):
+            results = self.sync_transactions([
+                {'hash': None, 'block_timestamp': '2024-01-01T00:00:00.000Z'},
+                {'hash': '0x1', 'block_timestamp': 'not a date'},
+                {'value': '1'},
+            ])
+        self.assertEqual(results['failed_syncs'], [])
+        self.assertEqual(results['transactions_synced'], 0)
+        self.assertFalse(Transaction.objects.exists())
+    
+    def test_mixed_timestamp_precision(self):
+        # Wrapped to check the exact amounts handed to the ORM (SQLite stores them as REAL)
+        with mock.patch.object(Transaction.objects, 'bulk_create', wraps=Transaction.objects.bulk_create) as saved:
+            results = self.sync_transactions([
+                {
+                    'hash': '0x1', 'block_number': '5', 'block_timestamp': '2024-01-01T00:00:00.000Z',
+                    'from_address': self.wallet.address, 'to_address': '0xdef',
+                    'value': '1', 'gas_price': '30000000007', 'receipt_gas_used': '21000', 'receipt_status': '1',
+                },
+                {
+                    'hash': '0x2', 'block_number': '6', 'block_timestamp': '2024-01-02T00:00:00Z',
+                    'from_address': '0xdef', 'to_address': self.wallet.address.lower(),
+                    'value': '123456789012345678901', 'gas_price': '10', 'receipt_gas_used': '21000', 'receipt_status': '0',
+                },
+            ])
+        self.assertEqual(results['failed_syncs'], [])
+        self.assertEqual(results['transactions_synced'], 2)
+        
+        # Wei amounts converted to ether without float rounding
+        rows = {row.transaction_hash: row for row in saved.call_args.args[0]}
+        self.assertEqual(rows['0x1'].value, Decimal('0.000000000000000001'))
+        self.assertEqual(rows['0x1'].transaction_fee, Decimal('0.000630000000147'))
+        self.assertEqual(rows['0x2'].value, Decimal('123.456789012345678901'))
+        self.assertEqual(rows['0x2'].transaction_fee, Decimal('0.00000000000021'))
+        
+        sent, received = Transaction.objects.order_by('transaction_hash')
+        self.assertEqual(sent.timestamp.isoformat(), '2024-01-01T00:00:00+00:00')
+        self.assertEqual(received.timestamp.isoformat(), '2024-01-02T00:00:00+00:00')
+        self.assertEqual((sent.transaction_type, received.transaction_type), ('send', 'receive'))
 
-class TokenTransfer(models.Model):
-    """Model for tracking token transfers within transactions"""
-    transaction = models.ForeignKey(Transaction, on_delete=models.CASCADE, related_name='token_transfers')
-    token = models.ForeignKey(Token, on_delete=models.CASCADE)
-    from_address = models.CharField(max_length=255)
-    to_address = models.CharField(max_length=255)
-    value = models.DecimalField(max_digits=36, decimal_places=18)
-    value_usd = models.DecimalField(max_digits=18, decimal_places=2, null=True, blank=True)
-    
-    def __str__(self):
-        return f"{self.token.symbol}: {self.value} from {self.from_address} to {self.to_address}"
 
-class RiskMetrics(models.Model):
-    """Model for tracking portfolio risk metrics"""
-    portfolio = models.OneToOneField(Portfolio, on_delete=models.CASCADE, related_name='risk_metrics')
-    volatility_30d = models.DecimalField(max_digits=7, decimal_places=2, null=True, blank=True)  # % 
-    volatility_90d = models.DecimalField(max_digits=7, decimal_places=2, null=True, blank=True)  # %
-    max_drawdown = models.DecimalField(max_digits=7, decimal_places=2, null=True, blank=True)  # %
-    sharpe_ratio = models.DecimalField(max_digits=5, decimal_places=2, null=True, blank=True)
-    value_at_risk = models.DecimalField(max_digits=7, decimal_places=2, null=True, blank=True)  # % 95% VaR
-    concentration_risk = models.DecimalField(max_digits=7, decimal_places=2, null=True, blank=True)  # % in top asset
-    last_updated = models.DateTimeField(auto_now=True)
-    
-    def __str__(self):
-        return f"Risk Metrics for {self.portfolio}"
\ No newline at end of file
+class PortfolioSyncTests(TestCase):
+    """The sync updates the portfolio from the stored wallet balances"""
+    
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(email='sync@example.com', password='x')
+        wallet = Wallet.objects.create(address='0xAbC0000000000000000000000000000000000002', chain='eth')
+        WalletUser.objects.create(user=self.user, wallet=wallet)
+        token = Token.objects.create(symbol='ETH', name='Ether', chain='eth')
+        WalletToken.objects.create(wallet=wallet, token=token, balance=Decimal('1'), balance_usd=Decimal('1000.00'))
+    
+    def sync(self):
+        # No Moralis calls, the portfolio is computed from the balances above
+        with mock.patch('assets.tasks._fetch_all_wallets', new=mock.AsyncMock(return_value=[{}])), \
+             mock.patch('assets.tasks._sync_one_wallet', return_value={
+                 'wallets_synced': 0, 'tokens_synced': 0, 'transactions_synced': 0, 'failed_syncs': []
+             }):
+            results = sync_user_wallets(self.user.id)
+        self.assertEqual(results['failed_syncs'], [])
+        return Portfolio.objects.get(user=self.user)
+    
+    def test_first_sync_seeds_previous_values(self):
+        portfolio = self.sync()
+        self.assertEqual(portfolio.previous_day_value_usd, Decimal('1000.00'))
+        self.assertEqual(portfolio.previous_week_value_usd, Decimal('1000.00'))
+        self.assertEqual(portfolio.previous_month_value_usd, Decimal('1000.00'))
+    
+    def test_zero_previous_value_is_kept(self):
+        Portfolio.objects.create(user=self.user, previous_day_value_usd=Decimal('0'))
+        portfolio = self.sync()
+        self.assertEqual(portfolio.previous_day_value_usd, Decimal('0'))
+        self.assertEqual(portfolio.previous_week_value_usd, Decimal('1000.00'))
+    
+    def snapshot_values_after_sync(self, age, value):
+        # Sync with one earlier snapshot of the given age and value
+        portfolio = Portfolio.objects.create(user=self.user)
+        PortfolioSnapshot.objects.create(portfolio=portfolio, total_value_usd=Decimal(value), timestamp=timezone.now() - age)
+        self.sync()
+        return list(portfolio.snapshots.order_by('timestamp').values_list('total_value_usd', flat=True))
+    
+    def test_first_sync_adds_snapshot(self):
+        portfolio = self.sync()
+        self.assertEqual(list(portfolio.snapshots.values_list('total_value_usd', flat=True)), [Decimal('1000.00')])
+    
+    def test_recent_snapshot_small_change_is_skipped(self):
+        # 0.05% below the current value, 10 minutes ago
+        values = self.snapshot_values_after_sync(timedelta(minutes=10), '999.50')
+        self.assertEqual(values, [Decimal('999.50')])
+    
+    def test_recent_snapshot_large_change_is_added(self):
+        # 10% below the current value, 10 minutes ago
+        values = self.snapshot_values_after_sync(timedelta(minutes=10), '900.00')
+        self.assertEqual(values, [Decimal('900.00'), Decimal('1000.00')])
+    
+    def test_old_snapshot_is_added(self):
+        # Same value, but older than SNAPSHOT_MIN_INTERVAL
+        values = self.snapshot_values_after_sync(timedelta(hours=1), '1000.00')
+        self.assertEqual(values, [Decimal('1000.00'), Decimal('1000.00')])
+
+
+class RollPortfolioWindowsTests(TestCase):
+    """Previous values come from the earliest snapshot inside each window"""
+    
+    def create_portfolio(self, email, snapshots, **previous):
+        user = get_user_model().objects.create_user(email=email, password='x')
+        portfolio = Portfolio.objects.create(user=user, **previous)
+        now = timezone.now()
+        PortfolioSnapshot.objects.bulk_create([
+            PortfolioSnapshot(portfolio=portfolio, total_value_usd=Decimal(value), timestamp=now - age)
+            for age, value in snapshots
+        ])
+        return portfolio
+    
+    def test_earliest_snapshot_in_each_window(self):
+        portfolio = self.create_portfolio('roll@example.com', [
+            (timedelta(days=40), '50.00'),
+            (timedelta(days=20), '100.00'),
+            (timedelta(days=25), '90.00'),
+            (timedelta(days=5), '200.00'),
+            (timedelta(hours=12), '300.00'),
+            (timedelta(hours=1), '310.00'),
+        ])
+        roll_portfolio_windows()
+        portfolio.refresh_from_db()
+        self.assertEqual(portfolio.previous_day_value_usd, Decimal('300.00'))
+        self.assertEqual(portfolio.previous_week_value_usd, Decimal('200.00'))
+        self.assertEqual(portfolio.previous_month_value_usd, Decimal('90.00'))
+    
+    def test_empty_window_keeps_stored_value(self):
+        portfolio = self.create_portfolio(
+            'stale@example.com', [(timedelta(days=3), '80.00')],
+            previous_day_value_usd=Decimal('0'),
+            previous_week_value_usd=Decimal('70.00'),
+            previous_month_value_usd=Decimal('60.00'),
+        )
+        roll_portfolio_windows()
+        portfolio.refresh_from_db()
+        self.assertEqual(portfolio.previous_day_value_usd, Decimal('0'))
+        self.assertEqual(portfolio.previous_week_value_usd, Decimal('80.00'))
+        self.assertEqual(portfolio.previous_month_value_usd, Decimal('80.00'))
+
+
+class SyncStatusViewTests(TestCase):
+    """Only the user who queued a sync can read its status"""
+    
+    def setUp(self):
+        self.owner = get_user_model().objects.create_user(email='owner@example.com', password='x')
+        self.other = get_user_model().objects.create_user(email='other@example.com', password='x')
+        self.client = APIClient()
+        self.url = reverse('sync-status', args=['task-1'])
+    
+    def stored_result(self, args, state='STARTED'):
+        # What the result backend holds once a worker has run the task
+        return mock.Mock(args=args, state=state, **{'successful.return_value': False, 'failed.return_value': False})
+    
+    @mock.patch('assets.views.AsyncResult')
+    def test_owner_gets_state(self, async_result):
+        async_result.return_value = self.stored_result([self.owner.id, False])
+        self.client.force_authenticate(self.owner)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'task_id': 'task-1', 'state': 'STARTED'})
+    
+    @mock.patch('assets.views.AsyncResult')
+    def test_other_user_gets_404(self, async_result):
+        async_result.return_value = self.stored_result([self.owner.id, False])
+        self.client.force_authenticate(self.other)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 404)
+    
+    @mock.patch('assets.views.AsyncResult')
+    def test_queued_task_is_pending(self, async_result):
+        async_result.return_value = self.stored_result(None, state='PENDING')
+        self.client.force_authenticate(self.owner)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, {'task_id': 'task-1', 'state': 'PENDING'})
\ No newline at end of file
@@ -1,7 +1,7 @@
 # assets/urls.py
 from django.urls import path
 from .views import (
-    PortfolioView, TransactionHistoryView, SyncWalletDataView
+    PortfolioView, TransactionHistoryView, SyncWalletDataView, SyncStatusView
 )
 
 urlpatterns = [
@@ -13,4 +13,7 @@ urlpatterns = [
     
     # Sync wallet data (all data)
     path('sync/', SyncWalletDataView.as_view(), name='sync-wallet-data'),
+    
+    # Status of a background sync
+    path('sync-status/<str:task_id>/', SyncStatusView.as_view(), name='sync-status'),
 ]
\ No newline at end of file
@@ -0,0 +1,13 @@
+# backend/celery.py
+import os
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+app = Celery('backend')
+
+# Read CELERY_* settings from the Django settings
+app.config_from_object('django.conf:settings', namespace='CELERY')
+
+# Find tasks.py in the installed apps
+app.autodiscover_tasks()
@@ -0,0 +1,23 @@
+# backend/renderers.py
+from decimal import Decimal
+import orjson
+from drf_orjson_renderer.renderers import ORJSONRenderer as BaseORJSONRenderer
+
+class ORJSONRenderer(BaseORJSONRenderer):
+    """
+    orjson-backed JSON renderer that keeps the output of DRF's JSONRenderer:
+    raw Decimals (e.g. from hand-built view responses) render as numbers and
+    UTC datetimes end in 'Z'. Serializer DecimalFields are already strings.
+    """
+    options = BaseORJSONRenderer.options | orjson.OPT_UTC_Z
+    
+    @staticmethod
+    def default(obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        # The base hook returns None for types it doesn't know, which would
+        # silently render as null
+        value = BaseORJSONRenderer.default(obj)
+        if value is None:
+            raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
+        return value
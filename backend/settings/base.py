@@ -2,6 +2,7 @@ from pathlib import Path
 import os
 import environ
 from datetime import timedelta
+from celery.schedules import crontab
 
 # Initialize environ (without any defaults yet)
 env = environ.Env()
@@ -78,6 +79,48 @@ REST_FRAMEWORK = {
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
     ],
+    "DEFAULT_RENDERER_CLASSES": [
+        "backend.renderers.ORJSONRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+}
+
+# Cache (Redis), used for short-lived Moralis responses. Cache errors are
+# ignored so a Redis outage only costs the cache hits.
+REDIS_URL = env('REDIS_URL', default='redis://localhost:6379/1')
+CACHES = {
+    "default": {
+        "BACKEND": "django_redis.cache.RedisCache",
+        "LOCATION": REDIS_URL,
+        "OPTIONS": {
+            "CLIENT_CLASS": "django_redis.client.DefaultClient",
+            "IGNORE_EXCEPTIONS": True,
+            "SOCKET_CONNECT_TIMEOUT": 2,
+            "SOCKET_TIMEOUT": 2,
+        },
+    }
+}
+
+# Celery (background wallet sync)
+CELERY_BROKER_URL = env('CELERY_BROKER_URL', default=REDIS_URL)
+CELERY_RESULT_BACKEND = env('CELERY_RESULT_BACKEND', default=REDIS_URL)
+CELERY_ACCEPT_CONTENT = ['json']
+CELERY_TASK_SERIALIZER = 'json'
+CELERY_RESULT_SERIALIZER = 'json'
+CELERY_RESULT_EXPIRES = timedelta(hours=1)
+# Store the task args with the result, SyncStatusView checks the owner against them
+CELERY_RESULT_EXTENDED = True
+CELERY_BEAT_SCHEDULE = {
+    # Refresh the previous day/week/month portfolio values
+    'roll-portfolio-windows': {
+        'task': 'assets.tasks.roll_portfolio_windows',
+        'schedule': crontab(hour=0, minute=5),
+    },
+    # Recalculate risk metrics for all portfolios
+    'refresh-risk-metrics': {
+        'task': 'assets.tasks.refresh_risk_metrics',
+        'schedule': crontab(hour=0, minute=30),
+    },
 }
 
 # JWT settings
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-14 19:01
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wallets', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='wallet',
+            name='users',
+            field=models.ManyToManyField(related_name='wallets', through='wallets.WalletUser', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
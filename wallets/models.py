@@ -9,6 +9,8 @@ class Wallet(models.Model):
     chain = models.CharField(max_length=50)  
     balance_usd = models.DecimalField(max_digits=18, decimal_places=2, null=True, blank=True)
     synced_at = models.DateTimeField(auto_now=True)
+    # Users tracking this wallet (lets wallets be filtered by user in one join)
+    users = models.ManyToManyField(settings.AUTH_USER_MODEL, through='WalletUser', related_name='wallets')
     
     class Meta:
         # Ensure each wallet address is unique per chain
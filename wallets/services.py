@@ -1,16 +1,71 @@
 # wallet/services.py
+import asyncio
+import functools
+import httpx
+import orjson
 import requests
 import logging
+from types import MappingProxyType
 from decimal import Decimal
 from django.conf import settings
+from django.core.cache import cache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+# Moralis rate limits and transient server errors are retried with backoff
+# (sync and async calls alike), the last response is still returned
+MORALIS_RETRIES = 3
+MORALIS_BACKOFF_FACTOR = 0.3
+MORALIS_RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+# Longest Retry-After (seconds) the async calls will wait for
+MORALIS_MAX_RETRY_AFTER = 30
+
+# Shared session so Moralis calls reuse pooled keep-alive connections
+# (sized for the concurrent wallet sync)
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=MORALIS_RETRIES,
+        backoff_factor=MORALIS_BACKOFF_FACTOR,
+        status_forcelist=MORALIS_RETRY_STATUSES,
+        allowed_methods=['GET'],
+        raise_on_status=False
+    )
+))
+MORALIS_HEADERS = {
+    'accept': 'application/json',
+    'X-API-Key': settings.MORALIS_API_KEY
+}
+_SESSION.headers.update(MORALIS_HEADERS)
+
+# (connect, read) timeouts in seconds for Moralis calls
+MORALIS_TIMEOUT = (3.05, 10)
+
+# How long (seconds) Moralis responses are served from the cache
+MORALIS_CACHE_TIMEOUT = 120
+
+def _cache_key(fn, address, chain, limit=None):
+    """Cache key for a Moralis response"""
+    return f"moralis:{fn}:{address}:{chain}:{limit}"
+
+def _retry_delay(response, attempt):
+    """Seconds to wait before retrying a Moralis response (Retry-After when the server sends it)"""
+    try:
+        return min(max(float(response.headers['Retry-After']), 0.0), MORALIS_MAX_RETRY_AFTER)
+    except (KeyError, ValueError):
+        return MORALIS_BACKOFF_FACTOR * (2 ** attempt)
+
 class MoralisService:
     """Service for interacting with Moralis API"""
     
     # Define the mapping between user-friendly chain names and Moralis chain identifiers
-    CHAIN_MAPPING = {
+    # (read-only so the memoized _resolve_chain can't go stale)
+    CHAIN_MAPPING = MappingProxyType({
         'eth': 'eth',
         'bsc': 'bsc', 
         'polygon': 'polygon',
@@ -18,46 +73,57 @@ class MoralisService:
         'fantom': 'fantom',
         'arbitrum': 'arbitrum',
         'optimism': 'optimism'
-    }
+    })
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=64)
+    def _resolve_chain(chain):
+        """Moralis chain identifier for a chain name (memoized)"""
+        return MoralisService.CHAIN_MAPPING.get(chain.lower(), chain)
     
     @classmethod
-    def get_wallet_net_worth(cls, address, chain=None):
+    def get_wallet_net_worth(cls, address, chain=None, force_refresh=False):
         """
         Fetch wallet net worth from Moralis API
         If chain is provided, will filter results for that specific chain
+        Responses are cached briefly, pass force_refresh=True to bypass the cache
         Returns tuple: (success_bool, data_or_error_message)
         """
         try:
+            # Serve a recent response from the cache
+            key = _cache_key('net_worth', address, chain)
+            if not force_refresh:
+                hit = cache.get(key)
+                if hit is not None:
+                    return True, hit
+            
             # Prepare the API call
             api_url = f"https://deep-index.moralis.io/api/v2.2/wallets/{address}/net-worth"
-            headers = {
-                'accept': 'application/json',
-                'X-API-Key': settings.MORALIS_API_KEY
-            }
             
             # Add chain parameter if specified
             params = {}
             if chain:
                 # Convert chain name to Moralis chain ID if needed
-                moralis_chain = cls.CHAIN_MAPPING.get(chain.lower(), chain)
+                moralis_chain = cls._resolve_chain(chain)
                 params['chains'] = [moralis_chain]
-                logger.info(f"Querying Moralis for wallet {address} on chain {moralis_chain}")
+                logger.info("Querying Moralis for wallet %s on chain %s", address, moralis_chain)
             else:
-                logger.info(f"Querying Moralis for wallet {address} across all chains")
+                logger.info("Querying Moralis for wallet %s across all chains", address)
             
             # Make the API call
-            response = requests.get(api_url, headers=headers, params=params)
+            response = _SESSION.get(api_url, params=params, timeout=MORALIS_TIMEOUT)
             
-            # Log the full response for debugging
-            logger.debug(f"Moralis API response: {response.text}")
+            # Log the full response for debugging (only decoded when DEBUG is on)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Moralis API response: %s", response.text)
             
             # Handle response
             if response.status_code == 200:
-                data = response.json()
+                data = orjson.loads(response.content)
                 
                 # If a specific chain was requested, filter the results
                 if chain and 'chains' in data:
-                    moralis_chain = cls.CHAIN_MAPPING.get(chain.lower(), chain)
+                    moralis_chain = cls._resolve_chain(chain)
                     # Find the chain data in the response
                     chain_data = None
                     for c in data['chains']:
@@ -69,6 +135,7 @@ class MoralisService:
                     if not chain_data:
                         return False, f"No data found for chain: {chain} (Moralis chain ID: {moralis_chain})"
                 
+                cache.set(key, data, timeout=MORALIS_CACHE_TIMEOUT)
                 return True, data
             else:
                 error_msg = f"Moralis API error: {response.status_code}, {response.text}"
@@ -82,29 +149,35 @@ class MoralisService:
 
     
     @classmethod
-    def get_wallet_tokens(cls, address, chain):
+    def get_wallet_tokens(cls, address, chain, force_refresh=False):
         """
         Fetch token balances for a wallet from Moralis API
+        Responses are cached briefly, pass force_refresh=True to bypass the cache
         Returns tuple: (success_bool, data_or_error_message)
         """
         try:
+            # Serve a recent response from the cache
+            key = _cache_key('tokens', address, chain)
+            if not force_refresh:
+                hit = cache.get(key)
+                if hit is not None:
+                    return True, hit
+            
             # Prepare the API call
             api_url = f"https://deep-index.moralis.io/api/v2.2/{address}/erc20"
-            headers = {
-                'accept': 'application/json',
-                'X-API-Key': settings.MORALIS_API_KEY
-            }
             
             # Convert chain name to Moralis chain ID if needed
-            moralis_chain = cls.CHAIN_MAPPING.get(chain.lower(), chain)
+            moralis_chain = cls._resolve_chain(chain)
             params = {'chain': moralis_chain}
             
             # Make the API call
-            response = requests.get(api_url, headers=headers, params=params)
+            response = _SESSION.get(api_url, params=params, timeout=MORALIS_TIMEOUT)
             
             # Handle response
             if response.status_code == 200:
-                return True, response.json()
+                data = orjson.loads(response.content)
+                cache.set(key, data, timeout=MORALIS_CACHE_TIMEOUT)
+                return True, data
             else:
                 error_msg = f"Moralis API error: {response.status_code}, {response.text}"
                 logger.error(error_msg)
@@ -116,29 +189,35 @@ class MoralisService:
             return False, error_msg
     
     @classmethod
-    def get_wallet_transactions(cls, address, chain, limit=100):
+    def get_wallet_transactions(cls, address, chain, limit=100, force_refresh=False):
         """
         Fetch transaction history for a wallet from Moralis API
+        Responses are cached briefly, pass force_refresh=True to bypass the cache
         Returns tuple: (success_bool, data_or_error_message)
         """
         try:
+            # Serve a recent response from the cache
+            key = _cache_key('transactions', address, chain, limit)
+            if not force_refresh:
+                hit = cache.get(key)
+                if hit is not None:
+                    return True, hit
+            
             # Prepare the API call
             api_url = f"https://deep-index.moralis.io/api/v2.2/{address}"
-            headers = {
-                'accept': 'application/json',
-                'X-API-Key': settings.MORALIS_API_KEY
-            }
             
             # Convert chain name to Moralis chain ID if needed
-            moralis_chain = cls.CHAIN_MAPPING.get(chain.lower(), chain)
+            moralis_chain = cls._resolve_chain(chain)
             params = {'chain': moralis_chain, 'limit': limit}
             
             # Make the API call
-            response = requests.get(api_url, headers=headers, params=params)
+            response = _SESSION.get(api_url, params=params, timeout=MORALIS_TIMEOUT)
             
             # Handle response
             if response.status_code == 200:
-                return True, response.json()
+                data = orjson.loads(response.content)
+                cache.set(key, data, timeout=MORALIS_CACHE_TIMEOUT)
+                return True, data
             else:
                 error_msg = f"Moralis API error: {response.status_code}, {response.text}"
                 logger.error(error_msg)
@@ -158,24 +237,20 @@ class MoralisService:
         try:
             # Prepare the API call
             api_url = f"https://deep-index.moralis.io/api/v2.2/{address}/erc20/transfers"
-            headers = {
-                'accept': 'application/json',
-                'X-API-Key': settings.MORALIS_API_KEY
-            }
             
             # Convert chain name to Moralis chain ID if needed
-            moralis_chain = cls.CHAIN_MAPPING.get(chain.lower(), chain)
+            moralis_chain = cls._resolve_chain(chain)
             params = {'chain': moralis_chain, 'limit': limit}
             
             if token_address:
                 params['token_addresses'] = token_address
             
             # Make the API call
-            response = requests.get(api_url, headers=headers, params=params)
+            response = _SESSION.get(api_url, params=params, timeout=MORALIS_TIMEOUT)
             
             # Handle response
             if response.status_code == 200:
-                return True, response.json()
+                return True, orjson.loads(response.content)
             else:
                 error_msg = f"Moralis API error: {response.status_code}, {response.text}"
                 logger.error(error_msg)
@@ -195,21 +270,17 @@ class MoralisService:
         try:
             # The endpoint may vary depending on what's available in Moralis
             api_url = f"https://deep-index.moralis.io/api/v2.2/wallets/{address}/positions"
-            headers = {
-                'accept': 'application/json',
-                'X-API-Key': settings.MORALIS_API_KEY
-            }
             
             # Convert chain name to Moralis chain ID if needed
-            moralis_chain = cls.CHAIN_MAPPING.get(chain.lower(), chain)
+            moralis_chain = cls._resolve_chain(chain)
             params = {'chain': moralis_chain}
             
             # Make the API call
-            response = requests.get(api_url, headers=headers, params=params)
+            response = _SESSION.get(api_url, params=params, timeout=MORALIS_TIMEOUT)
             
             # Handle response
             if response.status_code == 200:
-                return True, response.json()
+                return True, orjson.loads(response.content)
             else:
                 error_msg = f"Moralis API error: {response.status_code}, {response.text}"
                 logger.error(error_msg)
@@ -218,4 +289,109 @@ class MoralisService:
         except Exception as e:
             error_msg = f"Error fetching DeFi positions: {str(e)}"
             logger.exception(error_msg)
-            return False, error_msg
\ No newline at end of file
+            return False, error_msg
+    
+    # Async variants for fanning many calls out on one event loop (used by the
+    # wallet sync task). They take an httpx.AsyncClient from async_client().
+    
+    @staticmethod
+    def async_client():
+        """
+        HTTP/2 client for the async Moralis calls, pooled and with the API
+        headers set. A client is bound to its event loop, so create one per run.
+        """
+        return httpx.AsyncClient(
+            headers=MORALIS_HEADERS,
+            timeout=httpx.Timeout(MORALIS_TIMEOUT[1], connect=MORALIS_TIMEOUT[0]),
+            # (retries here only cover failed connection attempts, _aget retries by status)
+            transport=httpx.AsyncHTTPTransport(http2=True, retries=3, limits=httpx.Limits(max_connections=64))
+        )
+    
+    @classmethod
+    async def _aget(cls, client, key, api_url, params, error_label, force_refresh=False):
+        """
+        GET a Moralis endpoint with the shared response cache
+        Returns tuple: (success_bool, data_or_error_message)
+        """
+        try:
+            # Serve a recent response from the cache
+            if not force_refresh:
+                hit = await cache.aget(key)
+                if hit is not None:
+                    return True, hit
+            
+            # Make the API call, retrying rate limits and transient server errors
+            for attempt in range(MORALIS_RETRIES + 1):
+                response = await client.get(api_url, params=params)
+                if response.status_code not in MORALIS_RETRY_STATUSES or attempt == MORALIS_RETRIES:
+                    break
+                await asyncio.sleep(_retry_delay(response, attempt))
+            
+            # Log the full response for debugging (only decoded when DEBUG is on)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Moralis API response: %s", response.text)
+            
+            # Handle response
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                await cache.aset(key, data, timeout=MORALIS_CACHE_TIMEOUT)
+                return True, data
+            else:
+                error_msg = f"Moralis API error: {response.status_code}, {response.text}"
+                logger.error(error_msg)
+                return False, error_msg
+                
+        except Exception as e:
+            error_msg = f"Error fetching {error_label}: {str(e)}"
+            logger.exception(error_msg)
+            return False, error_msg
+    
+    @classmethod
+    async def aget_wallet_net_worth(cls, client, address, chain=None, force_refresh=False):
+        """
+        Async get_wallet_net_worth
+        Returns tuple: (success_bool, data_or_error_message)
+        """
+        params = {}
+        if chain:
+            moralis_chain = cls._resolve_chain(chain)
+            params['chains'] = [moralis_chain]
+            logger.info("Querying Moralis for wallet %s on chain %s", address, moralis_chain)
+        else:
+            logger.info("Querying Moralis for wallet %s across all chains", address)
+        success, data = await cls._aget(
+            client, _cache_key('net_worth', address, chain),
+            f"https://deep-index.moralis.io/api/v2.2/wallets/{address}/net-worth",
+            params, 'wallet net worth', force_refresh
+        )
+        
+        # If a specific chain was requested it has to be in the results
+        if success and chain and 'chains' in data:
+            moralis_chain = cls._resolve_chain(chain)
+            if not any(c.get('chain') == moralis_chain for c in data['chains']):
+                return False, f"No data found for chain: {chain} (Moralis chain ID: {moralis_chain})"
+        return success, data
+    
+    @classmethod
+    async def aget_wallet_tokens(cls, client, address, chain, force_refresh=False):
+        """
+        Async get_wallet_tokens
+        Returns tuple: (success_bool, data_or_error_message)
+        """
+        return await cls._aget(
+            client, _cache_key('tokens', address, chain),
+            f"https://deep-index.moralis.io/api/v2.2/{address}/erc20",
+            {'chain': cls._resolve_chain(chain)}, 'token balances', force_refresh
+        )
+    
+    @classmethod
+    async def aget_wallet_transactions(cls, client, address, chain, limit=100, force_refresh=False):
+        """
+        Async get_wallet_transactions
+        Returns tuple: (success_bool, data_or_error_message)
+        """
+        return await cls._aget(
+            client, _cache_key('transactions', address, chain, limit),
+            f"https://deep-index.moralis.io/api/v2.2/{address}",
+            {'chain': cls._resolve_chain(chain), 'limit': limit}, 'transactions', force_refresh
+        )
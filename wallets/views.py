@@ -119,11 +119,8 @@ class WalletView(APIView):
         
     def get(self, request):
         """Get all wallets for the authenticated user"""
-        # Get all wallet IDs for this user
-        wallet_ids = WalletUser.objects.filter(user=request.user).values_list('wallet_id', flat=True)
-        
-        # Get the wallet objects
-        wallets = Wallet.objects.filter(id__in=wallet_ids)
+        # Get the wallets for this user (only the serialized columns)
+        wallets = Wallet.objects.filter(users=request.user).only('address', 'balance_usd', 'chain')
         
         # Serialize and return
         serializer = WalletSerializer(wallets, many=True)
@@ -133,16 +130,15 @@ class WalletView(APIView):
         """Synchronize all wallets for the authenticated user"""
         try:
             # Get all wallets for this user
-            wallet_ids = WalletUser.objects.filter(user=request.user).values_list('wallet_id', flat=True)
-            wallets = Wallet.objects.filter(id__in=wallet_ids)
+            wallets = Wallet.objects.filter(users=request.user)
             
             # Track successfully synced wallets
             synced_wallets = []
             
             # Process each wallet
             for wallet in wallets:
-                # Call Moralis to get updated data
-                success, result = MoralisService.get_wallet_net_worth(wallet.address, wallet.chain)
+                # Call Moralis to get updated data (an explicit refresh, so skip the cache)
+                success, result = MoralisService.get_wallet_net_worth(wallet.address, wallet.chain, force_refresh=True)
                 
                 if not success or not isinstance(result, dict):
                     logger.warning(f"Failed to sync wallet {wallet.address} ({wallet.chain}): {result}")